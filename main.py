@@ -3,34 +3,139 @@ import os
 import random
 import string
 import asyncio
-from datetime import datetime, time
+import atexit
+import functools
+import gc
+import hmac
+import json
+import queue
+import signal
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, time, timezone
+from time import monotonic
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-from flask import Flask
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import threading
 
-# Инициализация Flask для Render.com
-app = Flask(__name__)
+# Ответы health-эндпоинтов для Render.com
+HEALTH_RESPONSES = {
+    '/': b"Bot is running!",
+    '/health': b"OK",
+}
 
-@app.route('/')
-def home():
-    return "Bot is running!"
+class HealthHandler(BaseHTTPRequestHandler):
+    """Минимальный HTTP-обработчик для проверок Render.com без Flask"""
+    def do_GET(self):
+        body = HEALTH_RESPONSES.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+    
+    do_HEAD = do_GET
+    
+    def do_POST(self):
+        # В режиме webhook обновления Telegram приходят на тот же порт, что и проверки Render
+        application = getattr(self.server, 'application', None)
+        if application is None or self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            self.send_error(403)
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            update = Update.de_json(data, application.bot)
+        except Exception:
+            # Не JSON или JSON, который не является обновлением Telegram
+            update = None
+        if update is None:
+            self.send_error(400)
+            return
+        # Обработка идет в event loop бота, HTTP-поток только передает обновление в очередь
+        asyncio.run_coroutine_threadsafe(application.update_queue.put(update), self.server.loop)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def log_message(self, format, *args):
+        # Пинги Render приходят постоянно, в общий лог их не пишем
+        pass
 
-@app.route('/health')
-def health():
-    return "OK"
+# Запись логов в поток вывода выполняет отдельный поток, чтобы не блокировать event loop бота
+log_queue = queue.Queue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
 
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    level=logging.DEBUG if os.getenv('BOT_DEBUG') == '1' else logging.INFO,
+    handlers=[queue_handler]
 )
+# httpx пишет INFO на каждый запрос к Bot API, включая каждый getUpdates
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не установлен")
 
+# Если задан публичный адрес сервиса, бот получает обновления через webhook вместо polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_PATH = '/webhook'
+# Путь webhook публичный - без секрета любой мог бы прислать поддельные обновления от имени игроков
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise ValueError("WEBHOOK_SECRET не установлен (обязателен при заданном WEBHOOK_URL)")
+
+# Названия карт для сообщений (собраны один раз, а не в каждом обработчике)
+THEME_NAMES = {'queen': 'Дамы', 'king': 'Короли', 'ace': 'Тузы'}
+CARD_NAMES = {**THEME_NAMES, 'joker': 'Джокеры'}
+CARD_SYMBOLS = {'queen': 'Q', 'king': 'K', 'ace': 'A', 'joker': 'J'}
+
+# Состав одной колоды: по 6 дам, королей и тузов и 2 джокера
+DECK_TEMPLATE = ('queen',) * 6 + ('king',) * 6 + ('ace',) * 6 + ('joker',) * 2
+CARDS_PER_PLAYER = 5
+
+MAX_ACTIVE_GAMES = 1000  # Верхняя граница числа комнат в памяти
+POLLING_TIMEOUT = 30  # Секунды long polling для getUpdates (по умолчанию в PTB всего 10)
+BROADCAST_RATE = 20  # Не больше стольких сообщений рассылки в секунду (лимит Telegram ~30/с)
+CLEANUP_WARNING_TIME = time(20, 45)  # UTC
+START_RATE_LIMIT = (3, 10)  # Не больше 3 /start от одного пользователя за 10 секунд
+CALLBACK_RATE_LIMIT = (20, 10)  # Не больше 20 нажатий кнопок за 10 секунд
+DAILY_CLEANUP_TIME = time(21, 0)  # UTC
+
+# Неизменяемые клавиатуры собираем один раз (объекты PTB неизменяемы, их можно переиспользовать)
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Создать комнату", callback_data="create_room")],
+    [InlineKeyboardButton("Правила игры", callback_data="show_rules")],
+    [InlineKeyboardButton("Присоединиться к игре", callback_data="join_game")]
+])
+BACK_TO_MAIN_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data="back_to_main")]])
+MAKE_MOVE_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🎴 Походить", callback_data="make_move")]])
+CHALLENGE_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🔍 Проверить игрока", callback_data="challenge")]])
+EMPTY_KEYBOARD = InlineKeyboardMarkup([])
+MOVE_CONTROL_ROWS = (
+    (InlineKeyboardButton("✅ Заявить", callback_data="confirm_move"),),
+    (InlineKeyboardButton("🗑️ Очистить выбор", callback_data="clear_selection"),),
+    (InlineKeyboardButton("🔙 Назад", callback_data="back_to_game"),),
+)
+
 active_games = {}
+player_rooms = {}  # Кэш user_id -> room_id, чтобы не перебирать все комнаты на каждый callback
+rate_windows = {}  # (user_id, действие) -> [начало окна, число запросов в нем]
 
 class LiarsBarGame:
     def __init__(self, game_id: str, creator_id: int):
@@ -45,22 +150,32 @@ class LiarsBarGame:
         self.player_revolvers = {}
         self.deck = []
         self.last_move_player_id = None
-        self.last_activity = datetime.now()
+        self.last_activity = monotonic()
         self.selected_cards = []  # Для хранения выбранных карт перед ходом
+        self.challenge_token = None  # Метка текущей анимации проверки, чтобы старая не трогала новый раунд
         
     def create_deck(self):
-        self.deck = []
-        self.deck.extend(['queen'] * 6)
-        self.deck.extend(['king'] * 6)
-        self.deck.extend(['ace'] * 6)
-        self.deck.extend(['joker'] * 2)
+        self.deck = list(DECK_TEMPLATE)
         random.shuffle(self.deck)
     
+    def deal_cards(self):
+        """Раздача карт всем игрокам, при нехватке добавляются новые колоды"""
+        total_cards_needed = len(self.players) * CARDS_PER_PLAYER
+        
+        while len(self.deck) < total_cards_needed:
+            additional_deck = list(DECK_TEMPLATE)
+            random.shuffle(additional_deck)
+            self.deck.extend(additional_deck)
+        
+        for i, player_id in enumerate(self.players):
+            start_index = i * CARDS_PER_PLAYER
+            self.player_hands[player_id] = self.deck[start_index:start_index + CARDS_PER_PLAYER]
+    
     def add_player(self, player_id: int, username: str):
         if player_id not in self.players:
             self.players.append(player_id)
             self.player_usernames.append(username)
-            self.last_activity = datetime.now()
+            self.last_activity = monotonic()
             return True
         return False
     
@@ -69,7 +184,7 @@ class LiarsBarGame:
             index = self.players.index(player_id)
             self.players.remove(player_id)
             self.player_usernames.pop(index)
-            self.last_activity = datetime.now()
+            self.last_activity = monotonic()
             
             # Если игрок был текущим, переходим к следующему
             if index == self.current_player_index:
@@ -96,25 +211,9 @@ class LiarsBarGame:
         self.theme = random.choice(['queen', 'king', 'ace'])
         
         # Раздача карт
-        cards_per_player = 5
-        total_cards_needed = len(self.players) * cards_per_player
+        self.deal_cards()
         
-        # Если в колоде недостаточно карт, создаем дополнительную колоду
-        while len(self.deck) < total_cards_needed:
-            additional_deck = []
-            additional_deck.extend(['queen'] * 6)
-            additional_deck.extend(['king'] * 6)
-            additional_deck.extend(['ace'] * 6)
-            additional_deck.extend(['joker'] * 2)
-            random.shuffle(additional_deck)
-            self.deck.extend(additional_deck)
-        
-        for i, player_id in enumerate(self.players):
-            start_index = i * cards_per_player
-            end_index = start_index + cards_per_player
-            self.player_hands[player_id] = self.deck[start_index:end_index]
-        
-        self.last_activity = datetime.now()
+        self.last_activity = monotonic()
         return True, "Игра началась"
     
     def play_cards(self, player_id: int, card_count: int, selected_cards: list):
@@ -144,16 +243,17 @@ class LiarsBarGame:
         # ВСЕГДА заявляем карты текущей темы, независимо от того, что на самом деле
         claimed_cards = [self.theme] * card_count
         
+        now = monotonic()
         self.table_cards.append({
             'player_id': player_id,
             'card_count': card_count,
             'claimed_cards': claimed_cards,  # Всегда заявляем карты темы
             'actual_cards': actual_cards,    # То, что на самом деле положили
-            'timestamp': asyncio.get_event_loop().time()
+            'timestamp': now
         })
         
         self.last_move_player_id = player_id
-        self.last_activity = datetime.now()
+        self.last_activity = now
         
         # Проверяем победу
         if len(hand) == 0:
@@ -175,12 +275,20 @@ class LiarsBarGame:
             return challenger_id != last_player_id, last_player_id
         
         # В обычном случае проверять может только следующий игрок
-        last_player_index = self.players.index(last_player_id)
-        next_player_index = (last_player_index + 1) % len(self.players)
-        next_player_id = self.players[next_player_index]
-        
+        next_player_id = self.get_challenger()
         return challenger_id == next_player_id, next_player_id
     
+    def get_challenger(self):
+        """Игрок, который может проверить последний ход (при 2 игроках это соперник походившего)"""
+        if not self.table_cards:
+            return None
+        last_player_id = self.table_cards[-1]['player_id']
+        # Походивший мог уже выйти из комнаты - тогда проверять некого
+        if last_player_id not in self.players:
+            return None
+        last_player_index = self.players.index(last_player_id)
+        return self.players[(last_player_index + 1) % len(self.players)]
+    
     def challenge_player(self, challenger_id: int):
         can_challenge, expected_player_id = self.can_challenge(challenger_id)
         if not can_challenge:
@@ -191,11 +299,10 @@ class LiarsBarGame:
         claimed_cards = last_move['claimed_cards']
         actual_cards = last_move['actual_cards']
         
-        # Проверяем, совпадают ли заявленные карты с реальными по теме
-        theme_cards_claimed = sum(1 for card in claimed_cards if card in [self.theme, 'joker'])
-        theme_cards_actual = sum(1 for card in actual_cards if card in [self.theme, 'joker'])
-        
-        is_lying = theme_cards_claimed != theme_cards_actual
+        # Заявляются всегда карты темы, поэтому игрок не врал, только если
+        # все реально положенные карты - карты темы или джокеры
+        matching_cards = frozenset((self.theme, 'joker'))
+        is_lying = not matching_cards.issuperset(actual_cards)
         
         if is_lying:
             # Игрок врал - проверяющий стреляет в него
@@ -214,27 +321,11 @@ class LiarsBarGame:
             self.create_deck()
             
             # Новая раздача карт всем игрокам
-            cards_per_player = 5
-            total_cards_needed = len(self.players) * cards_per_player
-            
-            # Если в колоде недостаточно карт, создаем дополнительную колоду
-            while len(self.deck) < total_cards_needed:
-                additional_deck = []
-                additional_deck.extend(['queen'] * 6)
-                additional_deck.extend(['king'] * 6)
-                additional_deck.extend(['ace'] * 6)
-                additional_deck.extend(['joker'] * 2)
-                random.shuffle(additional_deck)
-                self.deck.extend(additional_deck)
-            
-            for i, player_id in enumerate(self.players):
-                start_index = i * cards_per_player
-                end_index = start_index + cards_per_player
-                self.player_hands[player_id] = self.deck[start_index:end_index]
+            self.deal_cards()
             
             self.table_cards = []
         
-        self.last_activity = datetime.now()
+        self.last_activity = monotonic()
         
         return True, {
             'challenger_id': challenger_id,
@@ -261,11 +352,11 @@ class LiarsBarGame:
             elif index == self.current_player_index and self.players:
                 self.current_player_index = self.current_player_index % len(self.players)
             
-            self.last_activity = datetime.now()
+            self.last_activity = monotonic()
             return False
         else:
             revolver['current_position'] = (revolver['current_position'] + 1) % 6
-            self.last_activity = datetime.now()
+            self.last_activity = monotonic()
             return True
     
     def get_current_player(self):
@@ -274,21 +365,36 @@ class LiarsBarGame:
         return self.players[self.current_player_index]
     
     def get_player_username(self, player_id: int):
-        for i, pid in enumerate(self.players):
-            if pid == player_id:
-                return self.player_usernames[i]
+        if player_id in self.players:
+            return self.player_usernames[self.players.index(player_id)]
         return "Игрок"
 
+def rate_limit(action: str, limit: int, period: float):
+    """Ограничивает частоту вызова обработчика одним пользователем, лишние запросы отбрасываются"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+            key = (update.effective_user.id, action)
+            now = monotonic()
+            window = rate_windows.get(key)
+            if window is None or now - window[0] >= period:
+                rate_windows[key] = [now, 1]
+            elif window[1] >= limit:
+                # Обработчик не вызывается, поэтому на нажатие кнопки отвечаем здесь
+                if update.callback_query:
+                    await update.callback_query.answer("Подождите")
+                return
+            else:
+                window[1] += 1
+            return await handler(update, context, *args)
+        return wrapper
+    return decorator
+
+@rate_limit("start", *START_RATE_LIMIT)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("Создать комнату", callback_data="create_room")],
-        [InlineKeyboardButton("Правила игры", callback_data="show_rules")],
-        [InlineKeyboardButton("Присоединиться к игре", callback_data="join_game")]
-    ]
-    
     await update.message.reply_text(
         f"Привет {update.effective_user.first_name}!\nWerb Hub - Liar's Bar\n\nВыбери действие:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=MAIN_MENU_KEYBOARD
     )
 
 async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -300,18 +406,12 @@ async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Вы не в активной игре")
         return
     
-    room_id = game.game_id
-    
     # Удаляем игрока из игры
     game.remove_player(user_id)
     
     if len(game.players) < 2:
-        # Если остался 1 игрок - завершаем игру
-        if game.players:
-            winner = game.get_player_username(game.players[0])
-            await notify_players(game, context, f"🎉 ПОБЕДИТЕЛЬ: {winner}!")
-        if room_id in active_games:
-            del active_games[room_id]
+        # Если остался 1 игрок - он побеждает, комната в любом случае удаляется
+        await finish_game(game, context, game.players[0] if game.players else None)
         await update.message.reply_text("Вы вышли из игры. Комната удалена.")
     else:
         # Перезапускаем игру с оставшимися игроками
@@ -327,21 +427,7 @@ async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Запускаем игру заново
         success, message = game.start_game()
         if success:
-            theme_names = {'queen': 'Дамы', 'king': 'Короли', 'ace': 'Тузы'}
-            
-            for player_id in game.players:
-                try:
-                    hand = game.player_hands.get(player_id, [])
-                    hand_text = ", ".join([theme_names.get(card, card) for card in hand])
-                    
-                    await context.bot.send_message(
-                        player_id,
-                        f"🔄 Игра перезапущена!\n🎯 Тема: {theme_names.get(game.theme)}\n🎴 Твои карты: {hand_text}\n🔫 Револьвер заряжен!"
-                    )
-                except:
-                    pass
-            
-            await show_game_state(game, context)
+            await show_game_state(game, context, "🔄 Игра перезапущена!\n🔫 Револьвер заряжен!")
         
         await update.message.reply_text("Вы вышли из игры. Игра перезапущена для оставшихся игроков.")
 
@@ -357,58 +443,52 @@ async def join_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("Комната не найдена")
 
+@rate_limit("callback", *CALLBACK_RATE_LIMIT)
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     
     data = query.data
     user_id = query.from_user.id
     
-    logger.info(f"Callback received: {data} from user {user_id}")
+    logger.debug("Callback received: %s from user %s", data, user_id)
     
+    # Обработчики возвращают текст уведомления (или None), а на нажатие отвечаем ровно один раз:
+    # повторный answerCallbackQuery Telegram отклоняет, и уведомление не дошло бы до игрока
+    notice = None
     try:
-        if data == "create_room":
-            await create_room(update, context)
-        elif data == "show_rules":
-            await show_rules(update, context)
-        elif data == "join_game":
-            await join_game_info(update, context)
-        elif data == "back_to_main":
-            await back_to_main(update, context)
-        elif data.startswith("join_room_"):
-            room_id = data.split("_")[2]
-            await join_room(update, context, room_id)
-        elif data.startswith("start_room_"):
-            room_id = data.split("_")[2]
-            await start_room(update, context, room_id)
-        elif data == "make_move":
-            await show_move_interface(update, context)
-        elif data.startswith("select_card_"):
-            card_data = data.split("_")[2]
-            await select_card_handler(update, context, card_data)
-        elif data == "confirm_move":
-            await confirm_move_handler(update, context)
-        elif data == "clear_selection":
-            await clear_selection_handler(update, context)
-        elif data == "challenge":
-            await challenge_handler(update, context)
-        elif data.startswith("leave_room_"):
-            room_id = data.split("_")[2]
-            await leave_room(update, context, room_id)
-        elif data == "back_to_game":
-            game = await find_user_game(user_id)
-            if game:
-                await show_game_state(game, context)
+        handler = CALLBACK_HANDLERS.get(data)
+        if handler:
+            notice = await handler(update, context)
+        else:
+            # Кнопки с параметром: select_card_<i>, join_room_<id> и т.п.
+            action, _, arg = data.rpartition("_")
+            handler = CALLBACK_ARG_HANDLERS.get(action)
+            if handler:
+                notice = await handler(update, context, arg)
             
     except Exception as e:
-        logger.error(f"Ошибка в callback: {e}")
-        await query.answer("Ошибка")
+        logger.error("Ошибка в callback: %s", e)
+        notice = "Ошибка"
+    
+    await query.answer(notice)
 
 async def create_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
     username = query.from_user.username or query.from_user.first_name
     
+    # Несыгранная комната, где создатель остался один, брошена - не держим ее до очистки
+    old_game = await find_user_game(user_id)
+    if old_game and old_game.game_state == "waiting" and old_game.players == [user_id]:
+        active_games.pop(old_game.game_id, None)
+    
+    if len(active_games) >= MAX_ACTIVE_GAMES:
+        await query.edit_message_text(
+            "Сейчас слишком много активных комнат. Попробуй позже.",
+            reply_markup=BACK_TO_MAIN_KEYBOARD
+        )
+        return
+    
     room_id = ''.join(random.choices(string.digits, k=6))
     game = LiarsBarGame(room_id, user_id)
     game.player_usernames.append(f"@{username}")
@@ -433,28 +513,24 @@ async def join_room(update: Update, context: ContextTypes.DEFAULT_TYPE, room_id:
     username = query.from_user.username or query.from_user.first_name
     
     if room_id not in active_games:
-        await query.answer("Комната не найдена")
-        return
+        return "Комната не найдена"
     
     game = active_games[room_id]
     
     if user_id in game.players:
-        await query.answer("Вы уже в комнате")
-        return
+        return "Вы уже в комнате"
         
     if len(game.players) >= 4:
-        await query.answer("Комната заполнена")
-        return
+        return "Комната заполнена"
     
     game.add_player(user_id, f"@{username}")
     
-    # Уведомляем всех
-    for player_id in game.players:
-        if player_id != user_id:
-            try:
-                await context.bot.send_message(player_id, f"@{username} присоединился к комнате")
-            except:
-                pass
+    # Уведомляем всех одновременно
+    await asyncio.gather(
+        *(context.bot.send_message(player_id, f"@{username} присоединился к комнате")
+          for player_id in game.players if player_id != user_id),
+        return_exceptions=True
+    )
     
     players_text = "\n".join([f"• {name}" for name in game.player_usernames])
     
@@ -472,70 +548,64 @@ async def join_room(update: Update, context: ContextTypes.DEFAULT_TYPE, room_id:
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
     
-    await query.answer("Вы присоединились!")
+    return "Вы присоединились!"
 
 async def start_room(update: Update, context: ContextTypes.DEFAULT_TYPE, room_id: str):
     query = update.callback_query
     user_id = query.from_user.id
     
     if room_id not in active_games:
-        await query.answer("Комната не найдена")
-        return
+        return "Комната не найдена"
     
     game = active_games[room_id]
     
     if game.players[0] != user_id:
-        await query.answer("Только создатель может начать игру")
-        return
+        return "Только создатель может начать игру"
     
     if len(game.players) < 2:
-        await query.answer("Нужно минимум 2 игрока")
-        return
+        return "Нужно минимум 2 игрока"
     
     success, message = game.start_game()
     if success:
-        theme_names = {'queen': 'Дамы', 'king': 'Короли', 'ace': 'Тузы'}
-        
-        for player_id in game.players:
-            try:
-                hand = game.player_hands.get(player_id, [])
-                hand_text = ", ".join([theme_names.get(card, card) for card in hand])
-                
-                await context.bot.send_message(
-                    player_id,
-                    f"🎮 Игра началась!\n🎯 Тема: {theme_names.get(game.theme)}\n🎴 Твои карты: {hand_text}\n🔫 Револьвер заряжен!"
-                )
-            except:
-                pass
-        
-        await show_game_state(game, context)
+        await show_game_state(game, context, "🎮 Игра началась!\n🔫 Револьвер заряжен!")
     else:
-        await query.answer(message)
+        return message
+
+def require_game(handler):
+    """Находит игру пользователя и передает ее обработчику, иначе отвечает, что он не в игре"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+        query = update.callback_query
+        game = await find_user_game(query.from_user.id)
+        if not game:
+            return "Вы не в игре"
+        if game.game_state == "challenge":
+            return "Идет проверка, подожди"
+        return await handler(update, context, game, *args)
+    return wrapper
 
-async def show_move_interface(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@require_game
+async def show_move_interface(update: Update, context: ContextTypes.DEFAULT_TYPE, game: LiarsBarGame):
+    return await open_move_interface(update, context, game)
+
+async def open_move_interface(update: Update, context: ContextTypes.DEFAULT_TYPE, game: LiarsBarGame):
+    """Показывает выбор карт для хода в уже найденной игре"""
     query = update.callback_query
     user_id = query.from_user.id
     
-    game = await find_user_game(user_id)
-    if not game:
-        await query.answer("Вы не в игре")
-        return
-    
     if game.players[game.current_player_index] != user_id:
-        await query.answer("Не ваш ход")
-        return
+        return "Не ваш ход"
     
     # Очищаем предыдущий выбор
     game.selected_cards = []
     
     hand = game.player_hands.get(user_id, [])
-    theme_names = {'queen': 'Q', 'king': 'K', 'ace': 'A', 'joker': 'J'}
     
     # Создаем кнопки для выбора карт
     keyboard = []
     row = []
     for i, card in enumerate(hand):
-        card_symbol = theme_names.get(card, card)
+        card_symbol = CARD_SYMBOLS.get(card, card)
         row.append(InlineKeyboardButton(card_symbol, callback_data=f"select_card_{i}"))
         if len(row) == 3:  # 3 кнопки в ряд
             keyboard.append(row)
@@ -544,11 +614,7 @@ async def show_move_interface(update: Update, context: ContextTypes.DEFAULT_TYPE
         keyboard.append(row)
     
     # Кнопки управления
-    keyboard.extend([
-        [InlineKeyboardButton("✅ Заявить", callback_data="confirm_move")],
-        [InlineKeyboardButton("🗑️ Очистить выбор", callback_data="clear_selection")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_game")]
-    ])
+    keyboard.extend(MOVE_CONTROL_ROWS)
     
     await query.edit_message_text(
         "🎴 Выбери карты для хода (макс. 3):\n\n"
@@ -556,41 +622,38 @@ async def show_move_interface(update: Update, context: ContextTypes.DEFAULT_TYPE
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-async def select_card_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, card_index: str):
+@require_game
+async def select_card_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, game: LiarsBarGame, card_index: str):
     query = update.callback_query
     user_id = query.from_user.id
     
-    game = await find_user_game(user_id)
-    if not game:
-        await query.answer("Вы не в игре")
-        return
+    # Чужой ход - дальше ничего не считаем и не трогаем общий выбор карт
+    if game.get_current_player() != user_id:
+        return "Не ваш ход"
     
     index = int(card_index)
     hand = game.player_hands.get(user_id, [])
     
     if index >= len(hand):
-        await query.answer("Неверная карта")
-        return
+        return "Неверная карта"
     
     selected_card = hand[index]
     
     # Проверяем, не превышен ли лимит
     if len(game.selected_cards) >= 3:
-        await query.answer("Можно выбрать максимум 3 карты")
-        return
+        return "Можно выбрать максимум 3 карты"
     
     # Добавляем карту в выбранные
     game.selected_cards.append(selected_card)
     
     # Обновляем интерфейс
-    theme_names = {'queen': 'Q', 'king': 'K', 'ace': 'A', 'joker': 'J'}
-    selected_text = ", ".join([theme_names.get(card, card) for card in game.selected_cards])
+    selected_text = ", ".join([CARD_SYMBOLS.get(card, card) for card in game.selected_cards])
     
     hand = game.player_hands.get(user_id, [])
     keyboard = []
     row = []
     for i, card in enumerate(hand):
-        card_symbol = theme_names.get(card, card)
+        card_symbol = CARD_SYMBOLS.get(card, card)
         # Помечаем выбранные карты
         if card in game.selected_cards:
             card_symbol = f"✅{card_symbol}"
@@ -601,11 +664,7 @@ async def select_card_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     if row:
         keyboard.append(row)
     
-    keyboard.extend([
-        [InlineKeyboardButton("✅ Заявить", callback_data="confirm_move")],
-        [InlineKeyboardButton("🗑️ Очистить выбор", callback_data="clear_selection")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_game")]
-    ])
+    keyboard.extend(MOVE_CONTROL_ROWS)
     
     await query.edit_message_text(
         f"🎴 Выбери карты для хода (макс. 3):\n\n"
@@ -613,34 +672,32 @@ async def select_card_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
     
-    await query.answer(f"Выбрана карта: {theme_names.get(selected_card, selected_card)}")
+    return f"Выбрана карта: {CARD_SYMBOLS.get(selected_card, selected_card)}"
 
-async def clear_selection_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@require_game
+async def clear_selection_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, game: LiarsBarGame):
     query = update.callback_query
-    user_id = query.from_user.id
     
-    game = await find_user_game(user_id)
-    if not game:
-        await query.answer("Вы не в игре")
-        return
+    # Чужой ход - не трогаем выбор карт текущего игрока
+    if game.get_current_player() != query.from_user.id:
+        return "Не ваш ход"
     
     game.selected_cards = []
     
-    await show_move_interface(update, context)
-    await query.answer("Выбор очищен")
+    # Игра уже найдена декоратором, повторный поиск не нужен
+    await open_move_interface(update, context, game)
+    return "Выбор очищен"
 
-async def confirm_move_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@require_game
+async def confirm_move_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, game: LiarsBarGame):
     query = update.callback_query
     user_id = query.from_user.id
     
-    game = await find_user_game(user_id)
-    if not game:
-        await query.answer("Вы не в игре")
-        return
+    if game.get_current_player() != user_id:
+        return "Не ваш ход"
     
     if not game.selected_cards:
-        await query.answer("Сначала выбери карты")
-        return
+        return "Сначала выбери карты"
     
     card_count = len(game.selected_cards)
     selected_cards = game.selected_cards.copy()
@@ -649,15 +706,11 @@ async def confirm_move_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     
     if success:
         if "ПОБЕДА" in message:
-            await notify_players(game, context, f"🎉 {game.get_player_username(user_id)} ПОБЕДИЛ!")
-            # Автоматически удаляем комнату после победы
-            if game.game_id in active_games:
-                del active_games[game.game_id]
+            await finish_game(game, context, user_id)
             return
         
         # Уведомляем всех о ходе
-        theme_names = {'queen': 'Дамы', 'king': 'Короли', 'ace': 'Тузы', 'joker': 'Джокеры'}
-        claimed_text = ", ".join([theme_names.get(card, card) for card in [game.theme] * card_count])
+        claimed_text = ", ".join([CARD_NAMES.get(game.theme, game.theme)] * card_count)
         
         move_message = (
             f"🎴 {game.get_player_username(user_id)} походил!\n"
@@ -669,159 +722,150 @@ async def confirm_move_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await notify_players(game, context, move_message)
         await show_game_state(game, context)
     else:
-        await query.answer(message)
+        return message
 
-async def challenge_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@require_game
+async def challenge_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, game: LiarsBarGame):
     query = update.callback_query
     user_id = query.from_user.id
     
-    game = await find_user_game(user_id)
-    if not game:
-        await query.answer("Вы не в игре")
-        return
-    
     can_challenge, expected_player_id = game.can_challenge(user_id)
     if not can_challenge:
-        await query.answer("Сейчас не ваша очередь проверять")
-        return
-    
-    last_move = game.table_cards[-1]
-    target_player_id = last_move['player_id']
+        return "Сейчас не ваша очередь проверять"
     
-    # Анимация проверки для всех игроков
-    challenge_message = (
-        f"🔍 {game.get_player_username(user_id)} считает, что {game.get_player_username(target_player_id)} врет...\n"
-        f"⏳ Сейчас посмотрим..."
-    )
-    
-    await notify_players(game, context, challenge_message)
-    await asyncio.sleep(2)
+    target_player_id = game.table_cards[-1]['player_id']
+    challenger_username = game.get_player_username(user_id)
+    target_username = game.get_player_username(target_player_id)
     
     success, result = game.challenge_player(user_id)
+    if not success:
+        return
     
-    if success:
+    # Исход уже зафиксирован, а паузы анимации идут фоновой задачей,
+    # чтобы не задерживать обработку обновлений из других комнат
+    game.game_state = "challenge"
+    token = game.challenge_token = object()
+    context.application.create_task(
+        play_challenge_animation(game, context, token, challenger_username, target_username, result),
+        update=update
+    )
+
+def owns_challenge(game, token) -> bool:
+    """Комнату не завершили и не перезапустили, а проверка все еще та же, пока шли паузы анимации"""
+    return (active_games.get(game.game_id) is game
+            and game.game_state == "challenge"
+            and game.challenge_token is token)
+
+async def play_challenge_animation(game, context, token, challenger_username: str, target_username: str, result: dict):
+    """Анимация проверки и выстрела для уже разрешенного хода"""
+    try:
+        challenge_message = (
+            f"🔍 {challenger_username} считает, что {target_username} врет...\n"
+            f"⏳ Сейчас посмотрим..."
+        )
+        
+        await notify_players(game, context, challenge_message)
+        await asyncio.sleep(2)
+        if not owns_challenge(game, token):
+            return
+        
         # Показываем результат проверки
-        theme_names = {'queen': 'Дамы', 'king': 'Короли', 'ace': 'Тузы', 'joker': 'Джокеры'}
-        claimed_text = ", ".join([theme_names.get(card, card) for card in result['claimed_cards']])
-        actual_text = ", ".join([theme_names.get(card, card) for card in result['actual_cards']])
+        claimed_text = ", ".join([CARD_NAMES.get(card, card) for card in result['claimed_cards']])
+        actual_text = ", ".join([CARD_NAMES.get(card, card) for card in result['actual_cards']])
         
+        # Результат проверки и все кадры выстрела уходят одним сообщением:
+        # каждый кадр - это отдельная отправка каждому игроку в счет лимита Telegram
         result_message = (
             f"📋 Заявлено: {claimed_text}\n"
             f"🎴 Реально: {actual_text}\n"
-            f"❌ Врун: {'ДА' if result['is_lying'] else 'НЕТ'}"
+            f"❌ Врун: {'ДА' if result['is_lying'] else 'НЕТ'}\n\n"
+            f"🔫 {target_username} берет револьвер...\n"
+            f"💀 Подносит к виску...\n"
+            f"🎯 Нажимает на курок..."
         )
         
         await notify_players(game, context, result_message)
-        await asyncio.sleep(1.5)
-        
-        # Анимация выстрела
-        target_username = game.get_player_username(result['target_id'])
-        shoot_messages = [
-            f"🔫 {target_username} берет револьвер...",
-            f"💀 Подносит к виску...",
-            f"🎯 Нажимает на курок..."
-        ]
-        
-        for msg in shoot_messages:
-            await notify_players(game, context, msg)
-            await asyncio.sleep(1.5)
+        await asyncio.sleep(3)
+        if not owns_challenge(game, token):
+            return
         
         if result['survived']:
             await notify_players(game, context, "✅ ОСЕЧКА!")
             await asyncio.sleep(1)
-            
-            # Если остался только 1 игрок - он побеждает
-            if len(game.players) == 1:
-                winner = game.get_player_username(game.players[0])
-                await notify_players(game, context, f"🎉 ПОБЕДИТЕЛЬ: {winner}!")
-                if game.game_id in active_games:
-                    del active_games[game.game_id]
-                return
         else:
             await notify_players(game, context, f"💥 ВЫСТРЕЛ! {target_username} выбывает!")
             await asyncio.sleep(3)
-            
-            # Если остался только 1 игрок - он побеждает
-            if len(game.players) == 1:
-                winner = game.get_player_username(game.players[0])
-                await notify_players(game, context, f"🎉 ПОБЕДИТЕЛЬ: {winner}!")
-                if game.game_id in active_games:
-                    del active_games[game.game_id]
-                return
-        
-        # Показываем новое состояние игры
-        if len(game.players) > 1:
-            await show_game_state(game, context)
-        else:
-            winner = game.get_player_username(game.players[0])
-            await notify_players(game, context, f"🎉 ПОБЕДИТЕЛЬ: {winner}!")
-            # Автоматически удаляем комнату после победы
-            if game.game_id in active_games:
-                del active_games[game.game_id]
+        if not owns_challenge(game, token):
+            return
+    finally:
+        # Если за время анимации игру перезапустили через /stop и уже начали новую проверку,
+        # состояние принадлежит ей
+        if game.game_state == "challenge" and game.challenge_token is token:
+            game.game_state = "playing"
+    
+    # Сюда доходим, только если комната все еще наша
+    # Если остался только 1 игрок - он побеждает
+    if len(game.players) == 1:
+        await finish_game(game, context, game.players[0])
+        return
+    
+    # Показываем новое состояние игры
+    await show_game_state(game, context)
 
-async def show_game_state(game, context):
+async def show_game_state(game, context, header: str = None):
+    """Рассылка состояния раунда; header добавляется в начало того же сообщения"""
     current_player = game.get_current_player()
     if not current_player:
         return
-        
-    theme_names = {'queen': 'Дамы', 'king': 'Короли', 'ace': 'Тузы'}
     
-    for player_id in game.players:
+    # Общие для всех игроков части сообщения считаем один раз
+    header_lines = [header, ""] if header else []
+    theme_line = f"🎯 Тема раунда: {THEME_NAMES.get(game.theme)}"
+    players_line = f"👥 Игроков осталось: {len(game.players)}"
+    waiting_line = f"⏳ Сейчас ходит {game.get_player_username(current_player)}"
+    # Проверить последний ход может ровно один игрок - находим его один раз, а не для каждого получателя
+    challenger = game.get_challenger()
+    if challenger:
+        last_player = game.table_cards[-1]['player_id']
+        challenge_line = f"🔍 Можешь проверить {game.get_player_username(last_player)}!"
+        
+    async def send_state(player_id):
         try:
             hand = game.player_hands.get(player_id, [])
-            hand_text = ", ".join([theme_names.get(card, card) for card in hand])
+            hand_text = ", ".join([THEME_NAMES.get(card, card) for card in hand])
             
-            message = (
-                f"🎯 Тема раунда: {theme_names.get(game.theme)}\n"
-                f"🎴 Твои карты: {hand_text}\n"
-                f"👥 Игроков осталось: {len(game.players)}\n\n"
-            )
+            lines = [*header_lines, theme_line, f"🎴 Твои карты: {hand_text}", players_line, ""]
             
             if player_id == current_player:
-                message += "✅ Сейчас ТВОЙ ход!"
-                keyboard = [
-                    [InlineKeyboardButton("🎴 Походить", callback_data="make_move")],
-                ]
+                lines.append("✅ Сейчас ТВОЙ ход!")
+                keyboard = MAKE_MOVE_KEYBOARD
+            elif player_id == challenger:
+                lines.append(challenge_line)
+                keyboard = CHALLENGE_KEYBOARD
             else:
-                # Проверяем, может ли игрок проверять
-                can_challenge, _ = game.can_challenge(player_id)
-                if can_challenge and game.table_cards:
-                    last_player = game.table_cards[-1]['player_id']
-                    message += f"🔍 Можешь проверить {game.get_player_username(last_player)}!"
-                    keyboard = [
-                        [InlineKeyboardButton("🔍 Проверить игрока", callback_data="challenge")],
-                    ]
-                else:
-                    message += f"⏳ Сейчас ходит {game.get_player_username(current_player)}"
-                    keyboard = []
+                lines.append(waiting_line)
+                keyboard = EMPTY_KEYBOARD
             
-            await context.bot.send_message(player_id, message, reply_markup=InlineKeyboardMarkup(keyboard))
+            await context.bot.send_message(player_id, "\n".join(lines), reply_markup=keyboard)
         except Exception as e:
-            logger.error(f"Ошибка отправки сообщения игроку {player_id}: {e}")
+            logger.error("Ошибка отправки сообщения игроку %s: %s", player_id, e)
+    
+    # Отправляем состояние всем игрокам одновременно
+    await asyncio.gather(*(send_state(player_id) for player_id in game.players))
 
 async def leave_room(update: Update, context: ContextTypes.DEFAULT_TYPE, room_id: str):
     query = update.callback_query
     user_id = query.from_user.id
     
     if room_id not in active_games:
-        await query.answer("Комната не найдена")
-        return
+        return "Комната не найдена"
     
     game = active_games[room_id]
     
     if user_id not in game.players:
-        await query.answer("Вы не в комнате")
-        return
-    
-    # Правильно получаем username
-    username = None
-    for i, pid in enumerate(game.players):
-        if pid == user_id:
-            username = game.player_usernames[i]
-            break
+        return "Вы не в комнате"
     
-    if not username:
-        username = "Игрок"
+    username = game.get_player_username(user_id)
     
     game.remove_player(user_id)
     
@@ -845,17 +889,31 @@ async def leave_room(update: Update, context: ContextTypes.DEFAULT_TYPE, room_id
         )
 
 async def find_user_game(user_id: int):
+    # Сначала проверяем кэш, запись перепроверяется и сама устаревает
+    game = active_games.get(player_rooms.get(user_id))
+    if game and user_id in game.players:
+        return game
+    
     for game in active_games.values():
         if user_id in game.players:
+            player_rooms[user_id] = game.game_id
             return game
+    
+    player_rooms.pop(user_id, None)
     return None
 
+async def finish_game(game, context, winner_id: int = None):
+    """Объявление победителя (если он есть) и удаление комнаты"""
+    if winner_id is not None:
+        await notify_players(game, context, f"🎉 ПОБЕДИТЕЛЬ: {game.get_player_username(winner_id)}!")
+    active_games.pop(game.game_id, None)
+
 async def notify_players(game, context, message):
-    for player_id in game.players:
-        try:
-            await context.bot.send_message(player_id, message)
-        except:
-            pass
+    # Отправляем всем игрокам одновременно, ошибки отдельных отправок игнорируем
+    await asyncio.gather(
+        *(context.bot.send_message(player_id, message) for player_id in game.players),
+        return_exceptions=True
+    )
 
 async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -872,85 +930,152 @@ async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/join [ID] - присоединиться\n"
         "/stop - выйти из текущей игры"
     )
-    await query.edit_message_text(rules_text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data="back_to_main")]]))
+    await query.edit_message_text(rules_text, reply_markup=BACK_TO_MAIN_KEYBOARD)
 
 async def join_game_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.edit_message_text("Используй команду: /join [ID_комнаты]\n\nНапример: /join 123456")
 
+@require_game
+async def back_to_game(update: Update, context: ContextTypes.DEFAULT_TYPE, game: LiarsBarGame):
+    # Во время анимации проверки декоратор не пустит сюда: новая раздача еще не объявлена
+    await show_game_state(game, context)
+
 async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    keyboard = [
-        [InlineKeyboardButton("Создать комнату", callback_data="create_room")],
-        [InlineKeyboardButton("Правила игры", callback_data="show_rules")],
-        [InlineKeyboardButton("Присоединиться к игре", callback_data="join_game")]
-    ]
-    await query.edit_message_text("Главное меню:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text("Главное меню:", reply_markup=MAIN_MENU_KEYBOARD)
+
+# Таблицы разбора callback_data: один поиск в словаре вместо цепочки сравнений
+CALLBACK_HANDLERS = {
+    "make_move": show_move_interface,
+    "confirm_move": confirm_move_handler,
+    "challenge": challenge_handler,
+    "clear_selection": clear_selection_handler,
+    "back_to_game": back_to_game,
+    "create_room": create_room,
+    "show_rules": show_rules,
+    "join_game": join_game_info,
+    "back_to_main": back_to_main,
+}
+CALLBACK_ARG_HANDLERS = {
+    "select_card": select_card_handler,
+    "join_room": join_room,
+    "start_room": start_room,
+    "leave_room": leave_room,
+}
+
+async def broadcast_to_all_players(context: ContextTypes.DEFAULT_TYPE, message: str):
+    """Рассылка сообщения игрокам всех комнат с ограничением скорости отправки"""
+    # Снимок комнат: пока ждем отправку, обработчики могут менять active_games
+    player_ids = [player_id for game in list(active_games.values()) for player_id in game.players]
+    semaphore = asyncio.Semaphore(BROADCAST_RATE)
+    
+    async def send(player_id):
+        async with semaphore:
+            try:
+                await context.bot.send_message(player_id, message)
+            except Exception:
+                pass
+            # Слот освобождается через секунду - так рассылка не превышает BROADCAST_RATE в секунду
+            await asyncio.sleep(1)
+    
+    await asyncio.gather(*(send(player_id) for player_id in player_ids))
 
 def cleanup_inactive_games():
-    """Очистка неактивных игр (старше 2 часов)"""
-    current_time = datetime.now()
+    """Очистка неактивных игр (старше 2 часов) и ссылок на них в кэше player_rooms"""
+    # monotonic не зависит от перевода системных часов
+    current_time = monotonic()
     rooms_to_delete = []
     
     for room_id, game in active_games.items():
-        time_diff = current_time - game.last_activity
-        if time_diff.total_seconds() > 7200:  # 2 часа
+        if current_time - game.last_activity > 7200:  # 2 часа
             rooms_to_delete.append(room_id)
     
     for room_id in rooms_to_delete:
         del active_games[room_id]
-        logger.info(f"Удалена неактивная комната {room_id}")
+        logger.info("Удалена неактивная комната %s", room_id)
+    
+    # Убираем из кэша игроков ссылки на уже удаленные комнаты
+    stale_players = [user_id for user_id, room_id in player_rooms.items() if room_id not in active_games]
+    for user_id in stale_players:
+        del player_rooms[user_id]
 
-async def send_cleanup_warning(context: ContextTypes.DEFAULT_TYPE):
+def cleanup_rate_windows():
+    """Удаление окон ограничения частоты старше минуты - они уже ничего не ограничивают"""
+    current_time = monotonic()
+    stale_windows = [key for key, window in rate_windows.items() if current_time - window[0] > 60]
+    for key in stale_windows:
+        del rate_windows[key]
+
+async def send_cleanup_warning(context: ContextTypes.DEFAULT_TYPE, now: datetime):
     """Отправка предупреждения о скорой очистке"""
-    current_time = datetime.now().time()
-    warning_time = time(20, 45)  # 20:45 UTC
-    
-    if current_time.hour == warning_time.hour and current_time.minute == warning_time.minute:
+    if now.hour == CLEANUP_WARNING_TIME.hour and now.minute == CLEANUP_WARNING_TIME.minute:
         if active_games:
             warning_message = "⚠️ ВНИМАНИЕ: В 21:00 UTC все активные игры будут автоматически завершены для технического обслуживания!"
-            for game in active_games.values():
-                for player_id in game.players:
-                    try:
-                        await context.bot.send_message(player_id, warning_message)
-                    except:
-                        pass
+            await broadcast_to_all_players(context, warning_message)
             logger.info("Отправлены предупреждения о скорой очистке")
 
-async def perform_daily_cleanup(context: ContextTypes.DEFAULT_TYPE):
+async def perform_daily_cleanup(context: ContextTypes.DEFAULT_TYPE, now: datetime):
     """Ежедневная очистка в 21:00 UTC"""
-    current_time = datetime.now().time()
-    cleanup_time = time(21, 0)  # 21:00 UTC
-    
-    if current_time.hour == cleanup_time.hour and current_time.minute == cleanup_time.minute:
+    if now.hour == DAILY_CLEANUP_TIME.hour and now.minute == DAILY_CLEANUP_TIME.minute:
         if active_games:
             cleanup_message = "🔄 Техническое обслуживание: все активные игры завершены. Создавайте новые комнаты!"
-            for game in list(active_games.values()):
-                for player_id in game.players:
-                    try:
-                        await context.bot.send_message(player_id, cleanup_message)
-                    except:
-                        pass
+            await broadcast_to_all_players(context, cleanup_message)
+            # Сбрасываем все состояние разом, а не по одной комнате
             active_games.clear()
+            player_rooms.clear()
             logger.info("Выполнена ежедневная очистка всех комнат")
 
 def schedule_cleanup_tasks(application):
     """Планирование задач очистки"""
     async def cleanup_callback(context: ContextTypes.DEFAULT_TYPE):
         cleanup_inactive_games()
-        await send_cleanup_warning(context)
-        await perform_daily_cleanup(context)
+        cleanup_rate_windows()
+        # Время читаем один раз за тик и именно в UTC - сервер может жить в другом поясе
+        now = datetime.now(timezone.utc)
+        await send_cleanup_warning(context, now)
+        await perform_daily_cleanup(context, now)
     
     # Запускаем проверку каждую минуту
     job_queue = application.job_queue
     if job_queue:
         job_queue.run_repeating(cleanup_callback, interval=60, first=10)  # Каждую минуту
 
-def run_flask():
-    """Запуск Flask сервера для Render.com"""
+def create_health_server(application=None, loop=None):
+    """HTTP сервер проверок для Render.com; с application он же принимает webhook"""
     port = int(os.environ.get('PORT', 10000))
-    logger.info(f"Запуск Flask сервера на порту {port}")
-    app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
+    logger.info("Запуск health сервера на порту %s", port)
+    # Каждый запрос в своем потоке: медленный клиент /health не задерживает обновления Telegram
+    server = ThreadingHTTPServer(('0.0.0.0', port), HealthHandler)
+    server.application = application
+    server.loop = loop
+    return server
+
+def run_health_server():
+    """Запуск HTTP сервера проверок для Render.com"""
+    create_health_server().serve_forever()
+
+async def run_webhook(application, allowed_updates):
+    """Режим webhook: / и /health продолжают отвечать на том же порту, что и /webhook"""
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    async with application:
+        # Порт слушается до регистрации webhook, иначе первые доставки Telegram получат отказ
+        server = create_health_server(application, loop)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        await application.start()
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates
+        )
+        logger.info("Telegram бот запущен в режиме webhook")
+        await stop_event.wait()
+        await loop.run_in_executor(None, server.shutdown)
+        await application.stop()
 
 def run_bot():
     """Запуск Telegram бота"""
@@ -964,16 +1089,33 @@ def run_bot():
     # Планируем задачи очистки
     schedule_cleanup_tasks(application)
     
+    # Объекты, созданные при запуске, живут до конца процесса - исключаем их из проходов сборщика мусора
+    gc.collect()
+    gc.freeze()
+    
+    # Бот обрабатывает только команды и нажатия inline-кнопок, остальные типы не запрашиваем
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
+    
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application, allowed_updates))
+        return
+    
     logger.info("Telegram бот запущен")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Длинный опрос: Telegram держит getUpdates открытым до timeout секунд,
+    # PTB сам добавляет это время к таймауту чтения HTTP
+    application.run_polling(
+        allowed_updates=allowed_updates,
+        timeout=POLLING_TIMEOUT
+    )
 
 def main():
     """Основная функция запуска"""
     logger.info("Запуск приложения...")
     
-    # Запускаем Flask в отдельном потоке
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
+    # Запускаем health сервер в отдельном потоке (в режиме webhook его запускает run_webhook вместе с ботом)
+    if not WEBHOOK_URL:
+        health_thread = threading.Thread(target=run_health_server, daemon=True)
+        health_thread.start()
     
     # Запускаем бота в основном потоке
     run_bot()